@@ -1,71 +1,117 @@
 import requests
 import csv
-import json
-from datetime import datetime, timezone
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 import urllib3
 import argparse
+import functools
+import math
+import os
+import shelve
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operator import itemgetter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Session shared by all API calls
+POOL_MAXSIZE = 100
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=50, pool_maxsize=POOL_MAXSIZE,
+                       max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504]))
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+SESSION.headers.update({"Accept": "application/json"})
+SESSION.verify = False
+
+# On-disk cache of detector flags, shared between invocations of the script
+CACHE_FILE = '.rct_cache'
+CACHE_TTL = 3600  # seconds
+
+# Fields read from every run when building its row
+_RUN_FIELDS = itemgetter('runNumber', 'detectors_involved')
+
+def cache_key(flag_api_url, data_pass_id, run_number, detector_id):
+    """Key of the flags of one detector and run in the on-disk cache."""
+    return f"{flag_api_url}:{data_pass_id}:{run_number}:{detector_id}"
+
 def fetch_data_pass_ids(api_base_url, token):
     """Fetches all data passes and returns a dictionary mapping names to IDs."""
-    url = f"{api_base_url}/dataPasses?token={token}"
-    response = requests.get(url, verify=False)
-    data_passes = response.json().get('data', [])
+    response = SESSION.get(f"{api_base_url}/dataPasses", params={"token": token}, timeout=30)
+    data_passes = json_loads(response.content).get('data', [])
     return {dp['name']: dp['id'] for dp in data_passes}
 
 def fetch_runs(api_base_url, data_pass_id, token):
     """Fetches a list of runs for a given data pass ID from the API."""
-    url = f"{api_base_url}/runs?filter[dataPassIds][]={data_pass_id}&token={token}"
-    response = requests.get(url, verify=False)
-    runs = response.json().get('data', [])
+    params = {"filter[dataPassIds][]": data_pass_id, "token": token}
+    response = SESSION.get(f"{api_base_url}/runs", params=params, timeout=30)
+    runs = json_loads(response.content).get('data', [])
     
-    # Extract detectors involved in each run
+    # Extract detectors involved in each run, as a set since it is only used for membership tests
     for run in runs:
-        run['detectors_involved'] = run.get('detectors', '').split(',')
+        run['detectors_involved'] = frozenset(run.get('detectors', '').split(','))
     
     return runs
 
 def fetch_detector_flags(flag_api_url, data_pass_id, run_number, detector_id, token):
-    """Fetches quality flags for a specific detector and run."""
-    url = f"{flag_api_url}?dataPassId={data_pass_id}&runNumber={run_number}&dplDetectorId={detector_id}&token={token}"
-    response = requests.get(url, verify=False)
-    data = response.json()
+    """Fetches quality flags for a specific detector and run, sorted by 'updatedAt' timestamp."""
+    params = {"dataPassId": data_pass_id, "runNumber": run_number, "dplDetectorId": detector_id, "token": token}
+    response = SESSION.get(flag_api_url, params=params, timeout=30)
+    # Fail on an error response instead of reporting (and caching) the flags as not available
+    response.raise_for_status()
+    data = json_loads(response.content)
     flags = data.get('data', [])
-    
-    if not flags:
-        return ["Not Available"]
 
     # Sort flags by 'updatedAt' timestamp
     flags.sort(key=lambda x: x['updatedAt'])
+    return flags
+
+@functools.lru_cache(maxsize=200_000)
+def _ms_to_str(ms):
+    """Formats a timestamp in milliseconds as a UTC date string; memoized since flags share timestamps."""
+    # time.gmtime fills a plain struct_time, cheaper than building a datetime for every timestamp
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ms // 1000))
+
+def format_flags(flags):
+    """Formats the flags for CSV output, keeping only the latest flag of each interval."""
+    if not flags:
+        return "Not Available"
 
     intervals = {}
     for flag in flags:
         key = (flag['from'], flag['to'])
         intervals[key] = flag  # Keep only the latest flag for each interval
 
-    return list(intervals.values())
+    # Format straight from the dict view, without copying the flags into another list
+    latest_flags = intervals.values()
+    if len(latest_flags) == 1:
+        return next(iter(latest_flags))['flagType']['method']
+    return " | ".join(f"{flag['flagType']['method']} (from: {_ms_to_str(flag['from'])}, to: {_ms_to_str(flag['to'])})"
+                      for flag in latest_flags)
 
-def format_flags(flags):
-    """Formats the flags for CSV output."""
-    if flags == ["Not Available"]:
-        return "Not Available"
-    if len(flags) == 1:
-        return flags[0]['flagType']['method']
-    formatted_flags = []
-    for flag in flags:
-        formatted_flags.append(f"{flag['flagType']['method']} (from: {datetime.utcfromtimestamp(flag['from'] / 1000).strftime('%Y-%m-%d %H:%M:%S')}, to: {datetime.utcfromtimestamp(flag['to'] / 1000).strftime('%Y-%m-%d %H:%M:%S')})")
-    return " | ".join(formatted_flags)
+def fetch_formatted_flags(flag_api_url, data_pass_id, run_number, detector_id, token):
+    """Fetches the flags of a detector and run and formats them as a CSV cell."""
+    return format_flags(fetch_detector_flags(flag_api_url, data_pass_id, run_number, detector_id, token))
+
+def main(config_file, cache=None):
+    # Formatted flags cached from previous runs; a plain dict only memoizes within this run
+    if cache is None:
+        cache = {}
 
-def main(config_file):
     # Load configuration from the specified JSON file
-    with open(config_file, 'r') as file:
-        config = json.load(file)
+    with open(config_file, 'rb') as file:
+        config = json_loads(file.read())
     
     api_base_url = config['run_api_url']
     flag_api_url = config['flag_api_url']
     token = config['token']
     data_pass_names = config['dataPassNames']
+    # Number of parallel flag requests; never more than the session's connection pool
+    max_workers = min(int(config.get('max_workers', 16)), POOL_MAXSIZE)
 
     # Get mapping of data pass names to IDs
     data_pass_ids = fetch_data_pass_ids(api_base_url, token)
@@ -80,10 +126,10 @@ def main(config_file):
         
         # Filter runs by range if specified
         run_range = data_pass_info.get("run_range", [None, None])
-        if run_range[0] is not None:
-            runs = [run for run in runs if run['runNumber'] >= run_range[0]]
-        if run_range[1] is not None:
-            runs = [run for run in runs if run['runNumber'] <= run_range[1]]
+        if run_range[0] is not None or run_range[1] is not None:
+            lo = run_range[0] if run_range[0] is not None else -math.inf
+            hi = run_range[1] if run_range[1] is not None else math.inf
+            runs = [run for run in runs if lo <= run['runNumber'] <= hi]
         
         # Define the CSV filename based on the data pass name and run range
         safe_name = data_pass_name.replace(' ', '_').replace('/', '_')
@@ -96,32 +142,79 @@ def main(config_file):
         else:
             csv_filename = f'Runs_{safe_name}.csv'
         
-        with open(csv_filename, 'w', newline='') as file:
-            writer = csv.writer(file)
-            # Write headers with detector names
-            headers = ['Run Number'] + [name for name in config['detector_ids'].keys()]
-            writer.writerow(headers)
-
-            for run in runs:
-                run_number = run['runNumber']
-                row = [run_number]
-                
-                involved_detectors = run['detectors_involved']
-                
-                for detector_name, detector_id in config['detector_ids'].items():
-                    if detector_name not in involved_detectors:
-                        row.append("Not present")
-                    else:
-                        flags = fetch_detector_flags(flag_api_url, data_pass_id, run_number, detector_id, token)
-                        row.append(format_flags(flags))
-                
-                writer.writerow(row)
-    
+        detector_names = list(config['detector_ids'].keys())
+        # Formatted flags collected for each run until its row is written, and its flag requests still in flight
+        pending = [{} for _ in runs]
+        in_flight = [0] * len(runs)
+
+        # Flag requests not consumed yet; the CSV is written to a temporary file, renamed only on success
+        futures = {}
+        tmp_filename = csv_filename + '.part'
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                # Take the flags from the cache when still fresh, otherwise request them in parallel
+                now = time.time()
+                detector_items = list(config['detector_ids'].items())
+                for i, run in enumerate(runs):
+                    run_number, involved_detectors = _RUN_FIELDS(run)
+                    for detector_name, detector_id in detector_items:
+                        if detector_name not in involved_detectors:
+                            continue
+                        key = cache_key(flag_api_url, data_pass_id, run_number, detector_id)
+                        cached = cache.get(key)
+                        if cached is not None and now - cached[0] < CACHE_TTL:
+                            pending[i][detector_name] = cached[1]
+                        else:
+                            future = executor.submit(fetch_formatted_flags, flag_api_url, data_pass_id, run_number, detector_id, token)
+                            futures[future] = (i, detector_name, key)
+                            in_flight[i] += 1
+
+                with open(tmp_filename, 'w', newline='', buffering=1 << 20) as file:
+                    writer = csv.writer(file)
+                    # Write headers with detector names
+                    writer.writerow(['Run Number'] + detector_names)
+
+                    # Write the rows in run order as soon as all flags of a run are in, then drop them
+                    completed = as_completed(futures)
+                    next_row = 0
+                    while next_row < len(runs):
+                        if in_flight[next_row]:
+                            future = next(completed)
+                            i, detector_name, key = futures.pop(future)
+                            flags = future.result()
+                            pending[i][detector_name] = flags
+                            cache[key] = (time.time(), flags)
+                            in_flight[i] -= 1
+                            continue
+                        run_number, involved_detectors = _RUN_FIELDS(runs[next_row])
+                        flags_by_detector = pending[next_row]
+                        writer.writerow([run_number, *(flags_by_detector.get(detector_name, "Not Available")
+                                                       if detector_name in involved_detectors else "Not present"
+                                                       for detector_name in detector_names)])
+                        pending[next_row] = None
+                        next_row += 1
+            except BaseException:
+                # Do not send the queued requests, but keep the flags already fetched in the cache for the next run
+                executor.shutdown(cancel_futures=True)
+                for future, (_, _, key) in futures.items():
+                    if not future.cancelled() and future.exception() is None:
+                        cache[key] = (time.time(), future.result())
+                if os.path.exists(tmp_filename):
+                    os.remove(tmp_filename)
+                raise
+        os.replace(tmp_filename, csv_filename)
         print(f"Data has been written to {csv_filename}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Fetch run and detector data based on configuration.")
     parser.add_argument("config_file", help="Path to the JSON configuration file")
+    parser.add_argument("--cache", action="store_true", help="Reuse the detector flags fetched within the last hour from the on-disk cache; they may miss recently posted flags")
     args = parser.parse_args()
-    main(args.config_file)
+    cache = shelve.open(CACHE_FILE) if args.cache else {}
+    try:
+        main(args.config_file, cache)
+    finally:
+        if args.cache:
+            cache.close()
+        SESSION.close()
 
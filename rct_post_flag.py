@@ -1,31 +1,46 @@
 import requests
-import json
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 import argparse
 import urllib3
 import pandas as pd
 import os
 import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Session shared by all API calls; GETs are retried on overload or rate limiting
+POOL_MAXSIZE = 100
+SESSION = requests.Session()
+_retry = Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504], respect_retry_after_header=True)
+_adapter = HTTPAdapter(pool_connections=50, pool_maxsize=POOL_MAXSIZE, max_retries=_retry)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+SESSION.headers.update({"Accept": "application/json"})
+SESSION.verify = False
+
 def load_config(config_file):
     """Load the configuration file."""
-    with open(config_file, 'r') as file:
-        config = json.load(file)
+    with open(config_file, 'rb') as file:
+        config = json_loads(file.read())
     return config
 
 def fetch_data_pass_ids(api_base_url, token):
     """Fetches all data passes and returns a dictionary mapping names to IDs."""
-    url = f"{api_base_url}/dataPasses?token={token}"
-    response = requests.get(url, verify=False)
-    data_passes = response.json().get('data', [])
+    response = SESSION.get(f"{api_base_url}/dataPasses", params={"token": token}, timeout=30)
+    data_passes = json_loads(response.content).get('data', [])
     return {dp['name']: dp['id'] for dp in data_passes}
 
 def fetch_runs(api_base_url, data_pass_id, token):
     """Fetches a list of runs for a given data pass ID from the API."""
-    url = f"{api_base_url}/runs?filter[dataPassIds][]={data_pass_id}&token={token}"
-    response = requests.get(url, verify=False)
-    runs = response.json().get('data', [])
+    params = {"filter[dataPassIds][]": data_pass_id, "token": token}
+    response = SESSION.get(f"{api_base_url}/runs", params=params, timeout=30)
+    runs = json_loads(response.content).get('data', [])
     
     # Extract detectors involved in each run
     for run in runs:
@@ -33,194 +48,85 @@ def fetch_runs(api_base_url, data_pass_id, token):
     
     return runs
 
-def is_run_excluded(run_number, excluded_runs):
-    """Check if a run number is in the excluded runs list."""
-    return run_number in excluded_runs
-
-def read_csv_file(csv_file):
+def read_csv_file(csv_file, data_pass):
     """Read the CSV file and return a list of dictionaries with keys: given by the 1st row. Needed keys: post, run_number, a column with the name of a pass"""
-    df = pd.read_csv(csv_file)
+    # Only parse the columns used in batch mode, the other passes' columns are skipped by the parser
+    columns = {'post', 'run_number', 'comment', data_pass}
+    df = pd.read_csv(csv_file, usecols=lambda column: column in columns)
+    # Sanitize the columns once instead of checking every row: rows without a run number cannot be posted,
+    # and an empty comment is posted as a single space
+    missing_run_number = df['run_number'].isna()
+    # Report the rows to post that are dropped, with their line in the CSV file (the header is line 1)
+    for index in df.index[missing_run_number & (df['post'] == 'ok')]:
+        print(f"Error: Run number missing in line {index + 2} of {csv_file}, the flag is not posted.")
+    df = df[~missing_run_number].copy()
+    df['run_number'] = df['run_number'].astype('int64')
+    # The comment column is optional, a missing one is posted as empty comments
+    if 'comment' in df.columns:
+        df['comment'] = df['comment'].fillna(" ").astype(str)
+    else:
+        df['comment'] = " "
     return df.to_dict(orient='records')
 
+def format_run_list(runs):
+    """Format run numbers as a comma-separated list. pandas reads them as floats if the column has empty cells."""
+    return ", ".join(str(int(run)) if isinstance(run, float) and run.is_integer() else str(run) for run in runs)
+
+# Quality categories reported in the minutes, keyed by flagTypeId and listed in this order:
+# (sentence when all the runs have this quality, prefix of the list of runs, whether --no_diff applies)
+MINUTES_CATEGORIES = {
+    9: ("All the runs are GOOD.", "GOOD runs: ", False),
+    7: ("All the runs have been flagged as Bad tracking.", "Runs flagged as Bad tracking: ", True),
+    5: ("All the runs have been flagged as Limited acceptance (MC reproducible).", "Runs flagged as Limited acceptance (MC reproducible): ", True),
+    4: ("All the runs have been flagged as Limited acceptance (MC Not reproducible).", "Runs flagged as Limited acceptance (MC Not reproducible): ", True),
+    6: ("All the runs have been flagged as Bad PID.", "Runs flagged as Bad PID: ", True),
+    14: ("All the runs have been flagged as Unknown.", "Runs flagged as Unknown: ", False),
+    3: ("All the runs have been flagged as No Detector Data.", "Runs flagged as No Detector Data: ", False),
+}
+
 # function to produce the minutes for the aQC meeting
 def produce_minutes(csv_data, outputFile, flagTypeIdPass, noDiff):
-    # number of runs of each quality
-    n_runs = 0 # tot number of runs
-    n_good_runs = 0
-    n_bad_tracking = 0
-    n_lim_acc_runs = 0
-    n_lim_acc_no_rep_runs = 0
-    n_bad_pid_runs = 0
-    n_no_det_data_runs = 0
-    n_unknown_runs = 0
-
-    #list with the runs of each quality
-    runs = list()
-    good_runs = list()
-    bad_tracking = list()
-    lim_acc_runs = list()
-    lim_acc_no_rep_runs = list()
-    bad_pid_runs = list()
-    no_det_data_runs = list()
-    unknown_runs = list()
-
-    # write all the analyzed runs and fill the lists
-    f = open(outputFile, "a")
-    f.write('\nRuns: ')
-    for index, row in enumerate(csv_data):
+    # all the analyzed runs, and the runs of each quality
+    runs = []
+    runs_by_flag = {flag_type_id: [] for flag_type_id in MINUTES_CATEGORIES}
+    for row in csv_data:
         if(row['post'] != 'ok'):
             continue
         run_number = row["run_number"]
         runs.append(run_number)
-        n_runs = n_runs + 1
         print(run_number)
-        # good
-        if(row[flagTypeIdPass]==9):
-            n_good_runs = n_good_runs + 1
-            good_runs.append(run_number)
-        # bad tracking
-        if(row[flagTypeIdPass]==7):
-            n_bad_tracking = n_bad_tracking + 1
-            bad_tracking.append(run_number)
-        # lim acc (MC reproducible)
-        if(row[flagTypeIdPass]==5):
-            n_lim_acc_runs = n_lim_acc_runs + 1
-            lim_acc_runs.append(run_number)
-        # lim acc (MC Not reproducible)
-        if(row[flagTypeIdPass]==4):
-            n_lim_acc_no_rep_runs = n_lim_acc_no_rep_runs + 1
-            lim_acc_no_rep_runs.append(run_number)
-        # bad pid
-        if(row[flagTypeIdPass]==6):
-            n_bad_pid_runs = n_bad_pid_runs + 1
-            bad_pid_runs.append(run_number)
-        # no detector data
-        if(row[flagTypeIdPass]==3):
-            n_no_det_data_runs = n_no_det_data_runs + 1
-            no_det_data_runs.append(run_number)
-        # unknown
-        if(row[flagTypeIdPass]==14):
-            n_unknown_runs = n_unknown_runs + 1
-            unknown_runs.append(run_number)
-        
-    for run in range (0, n_runs):  
-        if(run != n_runs-1):
-            f.write(str(runs[run]).rstrip('.0') + ', ')
-        else:
-            f.write(str(runs[run]).rstrip('.0') + '.\n')
-    
-    sameQuality = 'The quality was the same in the previous pass.'
+        flag_runs = runs_by_flag.get(row[flagTypeIdPass])
+        if flag_runs is not None:
+            flag_runs.append(run_number)
 
-    # write the minutes based on the values found in the csv
-    if(n_good_runs==n_runs):
-        f.write("All the runs are GOOD.\n\n")
-        return
-
-    elif(n_bad_tracking==n_runs):
-        if noDiff:
-            f.write("All the runs have been flagged as Bad tracking. " + sameQuality + "\n\n")
-        else:
-            f.write("All the runs have been flagged as Bad tracking.\n\n")
-        return
+    # the minutes are collected in buf and written at once
+    buf = ['\nRuns: ']
+    if runs:
+        buf.append(format_run_list(runs) + '.\n')
 
-    elif(n_lim_acc_runs==n_runs):
-        if noDiff:
-            f.write("All the runs have been flagged as Limited acceptance (MC reproducible). " + sameQuality + ".\n\n")
-        else:
-            f.write("All the runs have been flagged as Limited acceptance (MC reproducible).\n\n")
-        return
-
-    elif(n_lim_acc_no_rep_runs==n_runs):
-        if noDiff:
-            f.write("All the runs have been flagged as Limited acceptance (MC Not reproducible). " + sameQuality + ".\n\n")
-        else:
-            f.write("All the runs have been flagged as Limited acceptance (MC Not reproducible).\n\n")
-        return
+    sameQuality = 'The quality was the same in the previous pass.'
 
-    elif(n_bad_pid_runs==n_runs):
-        if noDiff:
-            f.write("All the runs have been flagged as Bad PID. " + sameQuality + ".\n\n")
+    # write the minutes based on the values found in the csv
+    uniform = [flag_type_id for flag_type_id, flag_runs in runs_by_flag.items() if len(flag_runs) == len(runs)]
+    if uniform:
+        all_runs_text, _, no_diff_applies = MINUTES_CATEGORIES[uniform[0]]
+        if noDiff and no_diff_applies:
+            buf.append(all_runs_text + " " + sameQuality + "\n\n")
         else:
-            f.write("All the runs have been flagged as Bad PID.\n\n")
-        return
-
-    elif(n_no_det_data_runs==n_runs):
-        f.write("All the runs have been flagged as No Detector Data.\n\n")
-        return
-
-    elif(n_unknown_runs==n_runs):
-        f.write("All the runs have been flagged as Unknown.\n\n")
-        return
-
-    if(n_good_runs != 0):
-        f.write('GOOD runs: ')
-        for k in range(0, n_good_runs):
-            if(k != n_good_runs-1):
-                f.write(str(good_runs[k]) + ', ')
-            else:
-                f.write(str(good_runs[k]) + '.\n')
-
-    if(n_bad_tracking != 0):
-        f.write('Runs flagged as Bad tracking: ')
-        for k in range(0, n_bad_tracking):
-            if(k != n_bad_tracking-1):
-                f.write(str(bad_tracking[k]) + ', ')
-            else:
-                if noDiff:
-                    f.write(str(bad_tracking[k]) + '. ' + sameQuality + ' \n')
-                else:
-                    f.write(str(bad_tracking[k]) + '.\n')
-
-    if(n_lim_acc_runs != 0):
-        f.write('Runs flagged as Limited acceptance (MC reproducible): ')
-        for k in range(0, n_lim_acc_runs):
-            if(k != n_lim_acc_runs-1):
-                f.write(str(lim_acc_runs[k]) + ', ')
-            else:
-                if noDiff:
-                    f.write(str(lim_acc_runs[k]) + '. ' + sameQuality + ' \n')
-                else:
-                    f.write(str(lim_acc_runs[k]) + '.\n')
-
-    if(n_lim_acc_no_rep_runs != 0):
-        f.write('Runs flagged as Limited acceptance (MC Not reproducible): ')
-        for k in range(0, n_lim_acc_no_rep_runs):
-            if(k != n_lim_acc_no_rep_runs-1):
-                f.write(str(lim_acc_no_rep_runs[k]) + ', ')
-            else:
-                if noDiff:
-                    f.write(str(lim_acc_no_rep_runs[k]) + '. ' + sameQuality + ' \n')
-                else:
-                    f.write(str(lim_acc_no_rep_runs[k]) + '.\n')
-
-    if(n_bad_pid_runs != 0):
-        f.write('Runs flagged as Bad PID: ')
-        for k in range(0, n_bad_pid_runs):
-            if(k != n_bad_pid_runs-1):
-                f.write(str(bad_pid_runs[k]) + ', ')
-            else:
-                if noDiff:
-                    f.write(str(bad_pid_runs[k]) + '. ' + sameQuality + ' \n')
-                else:
-                    f.write(str(bad_pid_runs[k]) + '.\n')
-
-    if(n_unknown_runs != 0):
-        f.write('Runs flagged as Unknown: ')
-        for k in range(0, n_unknown_runs):
-            if(k != n_unknown_runs-1):
-                f.write(str(unknown_runs[k]) + ', ')
+            buf.append(all_runs_text + "\n\n")
+    else:
+        for flag_type_id, (_, list_prefix, no_diff_applies) in MINUTES_CATEGORIES.items():
+            flag_runs = runs_by_flag[flag_type_id]
+            if not flag_runs:
+                continue
+            if noDiff and no_diff_applies:
+                buf.append(list_prefix + format_run_list(flag_runs) + '. ' + sameQuality + ' \n')
             else:
-                f.write(str(unknown_runs[k]) + '.\n')
+                buf.append(list_prefix + format_run_list(flag_runs) + '.\n')
+        buf.append('\n')
 
-    if(n_no_det_data_runs != 0):
-        f.write('Runs flagged as No Detector Data: ')
-        for k in range(0, n_no_det_data_runs):
-            if(k != n_no_det_data_runs-1):
-                f.write(str(no_det_data_runs[k]) + ', ')
-            else:
-                f.write(str(no_det_data_runs[k]) + '.\n')
-
-    f.write('\n')
+    with open(outputFile, "a", buffering=1 << 20) as f:
+        f.write("".join(buf))
 
 # Set up argument parsing
 parser = argparse.ArgumentParser(description="Post a quality control flag.")
@@ -235,7 +141,10 @@ parser.add_argument('--excluded_runs', type=int, nargs='*', default=[], help='Li
 parser.add_argument('-b', '--batch', type=str, help='Path to CSV file for batch mode')
 parser.add_argument('--minutes', type=str, help='Name of the output file containing the minutes')
 parser.add_argument('--no_diff', action="store_true", help='Use this option if the non GOOD runs shows no difference wrt the previous pass')
+parser.add_argument('--concurrency', type=int, default=16, help='Number of flags posted in parallel (default 16)')
 args = parser.parse_args()
+# Runs to skip, as a set for constant-time membership checks
+EXCLUDED_RUNS = frozenset(args.excluded_runs)
 
 # Check for incompatible arguments
 if args.batch:
@@ -260,6 +169,12 @@ TOKEN = config['token']
 API_BASE_URL = config['run_api_url']
 FLAG_API_URL = config['flag_api_url']
 
+# Creating a flag is not idempotent: after a 5xx or a read timeout the flag may already have been created,
+# so POSTs to the flag API are only retried on 429, which is rejected before being processed
+_post_retry = Retry(total=5, read=0, backoff_factor=0.5, status_forcelist=[429],
+                    allowed_methods={"POST"}, respect_retry_after_header=True)
+SESSION.mount(FLAG_API_URL, HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=_post_retry))
+
 # Fetch data pass IDs
 data_pass_ids = fetch_data_pass_ids(API_BASE_URL, TOKEN)
 
@@ -290,16 +205,33 @@ def post_flag(run_number, flagTypeId, comment):
         "dplDetectorId": detector_id,  # Use the fetched detector ID
         "dataPassId": data_pass_id  # Use the fetched dataPassId
     }
-    # Make the POST request
-    response = requests.post(FLAG_API_URL, params={"token": TOKEN}, json=data, verify=False)
-
-    # Print the response
-    #print(f"Run {run_number} - Status Code:", response.status_code)
-    #print(f"Run {run_number} - Response Body:", response.json())
+    # Make the POST request; an error response counts as a failed post
+    response = SESSION.post(FLAG_API_URL, params={"token": TOKEN}, json=data, timeout=30)
+    response.raise_for_status()
+
+# Function to post several flags in parallel, each POST is independent
+def post_flags(entries):
+    """Post (run_number, flagTypeId, comment) entries concurrently over the pooled session.
+    A failed post does not stop the others; returns the run numbers whose flag could not be posted."""
+    max_workers = max(1, min(args.concurrency, POOL_MAXSIZE))
+    failed_runs = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(post_flag, *entry): entry[0] for entry in entries}
+        for future in as_completed(futures):
+            run_number = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error: posting the flag of run {run_number} failed: {e}")
+                failed_runs.append(run_number)
+    if failed_runs:
+        print(f"The flags of {len(failed_runs)} run(s) were not posted: {format_run_list(sorted(failed_runs))}")
+    return failed_runs
 
 if args.batch:
     # Batch mode
-    csv_data = read_csv_file(args.batch)
+    csv_data = read_csv_file(args.batch, args.data_pass)
+    to_post = []
     for row in csv_data:
         if(row["post"] != 'ok'):
             continue
@@ -307,12 +239,8 @@ if args.batch:
         if run_number not in run_numbers:
             print(f"Error: Run number {run_number} not found.")
             continue
-        comment = ""
-        if(pd.isna(row['comment'])):
-            comment = " "
-        else:
-            comment = row['comment']
-        post_flag(run_number, row[args.data_pass], comment)
+        to_post.append((run_number, row[args.data_pass], row['comment']))
+    failed_runs = post_flags(to_post)
 
     # create the minutes only in batch mode and if requested
     if(args.minutes):
@@ -326,11 +254,12 @@ if args.batch:
 
 else:
     # Non-batch mode
+    to_post = []
     for run in runs:
         run_number = run['runNumber']
         
         # Check if the run is excluded
-        if is_run_excluded(run_number, args.excluded_runs):
+        if run_number in EXCLUDED_RUNS:
             continue
 
         # Check if filtering by min_run and max_run is required
@@ -342,5 +271,10 @@ else:
         if args.detector not in involved_detectors:
             continue
 
-        post_flag(run_number, args.flagTypeId, args.comment)
+        to_post.append((run_number, args.flagTypeId, args.comment))
+    failed_runs = post_flags(to_post)
+
 
+SESSION.close()
+if failed_runs:
+    exit(1)
@@ -62,10 +62,6 @@ def fetch_flags(api_base_url, data_pass_id, run_number, detector_id, token):
 
     return list(latest_flags.values())
 
-def is_run_excluded(run_number, excluded_runs):
-    """Check if a run number is in the excluded runs list."""
-    return run_number in excluded_runs
-
 # Set up argument parsing
 parser = argparse.ArgumentParser(description="Verify quality control flags.")
 parser.add_argument('config', type=str, help='Path to the configuration file')
@@ -76,6 +72,8 @@ parser.add_argument('--max_run', type=int, help='Maximum run number')
 parser.add_argument('--excluded_runs', type=int, nargs='*', default=[], help='List of run numbers to exclude')
 parser.add_argument('--comment', type=str, default=None, help='Optional verification comment')
 args = parser.parse_args()
+# Runs to skip, as a set for constant-time membership checks
+EXCLUDED_RUNS = frozenset(args.excluded_runs)
 
 # Load configuration from the specified JSON file
 config = load_config(args.config)
@@ -111,7 +109,7 @@ for run in runs:
     run_number = run['runNumber']
     
     # Check if the run is excluded
-    if is_run_excluded(run_number, args.excluded_runs):
+    if run_number in EXCLUDED_RUNS:
         print(f"Skipping excluded run {run_number}")
         continue
 
@@ -1,23 +1,43 @@
-import json
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 import gspread
 import datetime
 import argparse
+import shelve
+import time
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from oauth2client.service_account import ServiceAccountCredentials
+from google.auth.transport.requests import AuthorizedSession
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 parser = argparse.ArgumentParser(description='Process ALICE Run3 runlist.')
 parser.add_argument('config_file', type=str, help='Configuration file path')
+parser.add_argument('--cache', action='store_true', help='Reuse the sheet values fetched within the last hour from the on-disk cache; they may miss recent edits of the sheet')
 args = parser.parse_args()
 
+# On-disk cache of the fetched tab values, shared between invocations of the script
+CACHE_FILE = '.runlist_cache'
+CACHE_TTL = 3600  # seconds
+# Size of the connection pool of the Google API session, which bounds the number of spreadsheets fetched in parallel
+POOL_MAXSIZE = 10
+
 def read_config(file_path):
-    with open(file_path, 'r') as file:
-        return json.load(file)
+    with open(file_path, 'rb') as file:
+        return json_loads(file.read())
 
-def get_detector_column_index(detector, header_row, pass_id):
-    return header_row.index(detector) + pass_id + 1
+def row_getter(indices):
+    """Returns a function picking the given columns of a row as a tuple, like itemgetter but also for a single column."""
+    if len(indices) == 1:
+        index = indices[0]
+        return lambda row: (row[index],)
+    return itemgetter(*indices)
 
-def check_run_quality_2022(run_row, detector_indices, qualities, current_period, period_column_index, allowed_periods, separate_22o_test):
-    period_raw = run_row[period_column_index].strip()
+def check_run_quality_2022(period_raw, detector_cells, quality_flag_sets, current_period, allowed_mask, period_bits, separate_22o_test):
     period = ''
     if period_raw == '' and (current_period == "LHC22o_test" or current_period == "LHC22o") and separate_22o_test == "True":
         current_period = "LHC22o"
@@ -32,68 +52,168 @@ def check_run_quality_2022(run_row, detector_indices, qualities, current_period,
         period = current_period
     #period = run_row[period_column_index].strip() or current_period
     #if allowed_periods and period not in allowed_periods:
-    if "LHC22o" in allowed_periods and separate_22o_test == "False":  
-        if allowed_periods and current_period not in allowed_periods and current_period != "LHC22o_test" or period_raw == 'BAD':
+    # A period is allowed if its bit is set in allowed_mask; periods without a bit are never allowed
+    current_allowed = period_bits.get(current_period, 0) & allowed_mask
+    if period_bits["LHC22o"] & allowed_mask and separate_22o_test == "False":  
+        if allowed_mask and not current_allowed and current_period != "LHC22o_test" or period_raw == 'BAD':
             return False, period
     else: 
-        if allowed_periods and current_period not in allowed_periods or period_raw == 'BAD':
+        if allowed_mask and not current_allowed or period_raw == 'BAD':
             return False, period
-    for detector, quality_flags in qualities.items():
-        if run_row[detector_indices[detector]-1].strip() not in quality_flags:
-            #print(detector,run_row[detector_indices[detector]-1].strip())
+    for cell, quality_flags in zip(detector_cells, quality_flag_sets):
+        if cell not in quality_flags:
+            #print(cell)
             return False, period
-        #print(detector,run_row[detector_indices[detector]-1].strip())
+        #print(cell)
     return True, period
 
-def check_run_quality(run_row, detector_indices, qualities, current_period, period_column_index, allowed_periods):
-    period = run_row[period_column_index].strip() or current_period
+def check_run_quality(period_raw, detector_cells, quality_flag_sets, current_period, allowed_periods):
+    period = period_raw or current_period
     if allowed_periods and period not in allowed_periods:
         return False, period
 
-    for detector, quality_flags in qualities.items():
-        if run_row[detector_indices[detector]-1].strip() not in quality_flags:
-            #print(detector,run_row[detector_indices[detector]-1].strip())
+    for cell, quality_flags in zip(detector_cells, quality_flag_sets):
+        if cell not in quality_flags:
+            #print(cell)
             return False, period
-        #print(detector,run_row[detector_indices[detector]-1].strip())
+        #print(cell)
     return True, period
 
+def fetch_tabs(spreadsheet, tab_names):
+    """Fetches the values of several tabs in one batchGet request, padded to full rows like get_all_values."""
+    ranges = ["'{}'".format(tab_name.replace("'", "''")) for tab_name in tab_names]
+    value_ranges = spreadsheet.values_batch_get(ranges)['valueRanges']
+    tabs = {}
+    for tab_name, value_range in zip(tab_names, value_ranges):
+        values = value_range.get('values', [])
+        width = max(map(len, values), default=0)
+        tabs[tab_name] = [row + [''] * (width - len(row)) for row in values]
+    return tabs
+
+def fetch_sheet(client, sheet_name, tab_names):
+    """Opens a spreadsheet and fetches the given tabs of it; run in a worker thread."""
+    spreadsheet = client.open(sheet_name)
+    #print(f'sheet name: {spreadsheet}')
+    return fetch_tabs(spreadsheet, tab_names)
+
 config = read_config(args.config_file)
+# The quality flags are only used for membership tests, turn them into sets once
+for sheet_config in config['sheets']:
+    for runlist_config in sheet_config['runlists']:
+        detectors = runlist_config['detectors']
+        for detector, quality_flags in detectors.items():
+            detectors[detector] = frozenset(quality_flags)
 scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-credentials = ServiceAccountCredentials.from_json_keyfile_name('runlist-5dfcf12a816d.json', scope)
-client = gspread.authorize(credentials)
+credentials = Credentials.from_service_account_file('runlist-5dfcf12a816d.json', scopes=scope)
+# Session shared by all Google API calls, retrying when the quota is exceeded
+session = AuthorizedSession(credentials)
+session.mount('https://', HTTPAdapter(pool_connections=POOL_MAXSIZE, pool_maxsize=POOL_MAXSIZE,
+                                      max_retries=Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 503])))
+client = gspread.Client(auth=credentials, session=session)
+
+# Tabs needed from each spreadsheet, so that every spreadsheet is opened once and its tabs fetched in one request
+tabs_by_sheet = {}
+for sheet_config in config['sheets']:
+    tab_names = tabs_by_sheet.setdefault(sheet_config.get('sheet_name'), [])
+    if sheet_config['tab_name'] not in tab_names:
+        tab_names.append(sheet_config['tab_name'])
+
+# All values of the tabs by (sheet name, tab name), taken from the cache when requested and still fresh
+tab_values = {}
+cache = shelve.open(CACHE_FILE) if args.cache else {}
+try:
+    now = time.time()
+    missing_tabs_by_sheet = {}
+    for sheet_name, tab_names in tabs_by_sheet.items():
+        for tab_name in tab_names:
+            cached = cache.get(repr((sheet_name, tab_name)))
+            if cached is not None and now - cached[0] < CACHE_TTL:
+                tab_values[(sheet_name, tab_name)] = cached[1]
+            else:
+                missing_tabs_by_sheet.setdefault(sheet_name, []).append(tab_name)
+    # The spreadsheets are fetched in parallel
+    if missing_tabs_by_sheet:
+        max_workers = min(int(config.get('max_workers', 8)), POOL_MAXSIZE)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(fetch_sheet, client, sheet_name, missing_tabs): sheet_name
+                       for sheet_name, missing_tabs in missing_tabs_by_sheet.items()}
+            # The cache is only written from the main thread
+            for future in as_completed(futures):
+                sheet_name = futures[future]
+                for tab_name, values in future.result().items():
+                    tab_values[(sheet_name, tab_name)] = values
+                    cache[repr((sheet_name, tab_name))] = (time.time(), values)
+finally:
+    if args.cache:
+        cache.close()
 
 current_date = datetime.datetime.now().strftime("%Y-%m-%d")
 for sheet_config in config['sheets']:
-    spreadsheet = client.open(sheet_config.get('sheet_name'))
-    #print(f'sheet name: {spreadsheet}')
+    sheet_name = sheet_config.get('sheet_name')
     allowed_periods = sheet_config.get('periods', None)
-    worksheet = spreadsheet.worksheet(sheet_config['tab_name'])
+    # Set of the allowed periods for the checks; the list keeps the configured order for the file name
+    allowed_period_set = frozenset(allowed_periods or ())
     pass_id = int(sheet_config.get('pass_shift', 1))
     pass_name = sheet_config.get('pass_name', None)
     separate_22o_test  =  sheet_config.get('separate_22o_test', False)
- 
+    # Detectors listed in detector_priority are checked first, so that rows are rejected as early as possible
+    detector_priority = {detector: i for i, detector in enumerate(sheet_config.get('detector_priority', []))}
+    # The header rows are sliced from the fetched tab instead of being requested separately, once for all its runlists
+    rows = tab_values[(sheet_name, sheet_config['tab_name'])]
+    header_row_period = rows[0]
+    header_row = rows[1]
+    #print(header_row)
+    period_column_index = header_row_period.index('Period')
+    # Position of each header name, looked up once per detector instead of scanning the header row;
+    # the first occurrence wins, as with header_row.index
+    header_pos = {}
+    for i, name in enumerate(header_row):
+        header_pos.setdefault(name, i)
+    # The 2022 sheet has its own period logic and the run number in the first column; resolve this once, not per row
+    if sheet_name == "QC_summary_data_2022":
+        # Small integer bit per period, and the mask of the allowed ones, for cheap period checks per row
+        period_bits = {period: 1 << i for i, period in enumerate(dict.fromkeys([*allowed_period_set, "LHC22o", "LHC22o_test"]))}
+        allowed_mask = 0
+        for period in allowed_period_set:
+            allowed_mask |= period_bits[period]
+        check_fn, run_col, allowed, extra_args = check_run_quality_2022, 0, allowed_mask, (period_bits, separate_22o_test)
+    else:
+        check_fn, run_col, allowed, extra_args = check_run_quality, 3, allowed_period_set, ()
+
+    # Column indices and accepted quality flags of the detectors of each runlist, computed once for all the rows
+    runlist_detectors = []
     for runlist_config in sheet_config['runlists']:
-        header_row_period = worksheet.row_values(1)
-        header_row = worksheet.row_values(2)
-        #print(header_row)
-        unique_periods = set()
+        detectors = sorted(runlist_config['detectors'].items(), key=lambda item: detector_priority.get(item[0], len(detector_priority)))
+        detector_columns = [header_pos[detector] + pass_id for detector, _ in detectors]
+        # Every cell of a row is picked before the checks, so a column beyond the tab is a configuration error
+        if detector_columns and max(detector_columns) >= len(header_row):
+            outside = [detector for (detector, _), column in zip(detectors, detector_columns) if column >= len(header_row)]
+            print(f'Error: with pass_shift {pass_id}, the column of {", ".join(outside)} is beyond the {len(header_row)} columns of tab {sheet_config["tab_name"]}. Runlist {runlist_config["name"]} is not generated.')
+            continue
+        quality_flag_sets = [quality_flags for _, quality_flags in detectors]
+        runlist_detectors.append((runlist_config, detector_columns, quality_flag_sets))
+    # Only the columns checked by the runlists of the tab are stripped, once for all of them
+    data_rows = rows[3:]
+    read_columns = sorted({period_column_index}.union(*(detector_columns for _, detector_columns, _ in runlist_detectors)))
+    read_column_pos = {column: i for i, column in enumerate(read_columns)}
+    get_read_cells = row_getter(read_columns)
+    stripped_rows = [[cell.strip() for cell in get_read_cells(row)] for row in data_rows]
+
+    for runlist_config, detector_columns, quality_flag_sets in runlist_detectors:
         default_periods = set()
+        add_default_period = default_periods.add
 
-        period_column_index = header_row_period.index('Period')
-        detector_indices = {detector: get_detector_column_index(detector, header_row, pass_id) for detector in runlist_config['detectors'].keys()}
+        # Picks the period cell and the detector cells of a stripped row in one call
+        get_cells = row_getter([read_column_pos[period_column_index], *(read_column_pos[column] for column in detector_columns)])
         runlist = []
         current_period = ''
-        rows = worksheet.get_all_values()
 
-        for row in rows[3:]:
-            if sheet_config.get('sheet_name') == "QC_summary_data_2022":
-                is_good_run, current_period = check_run_quality_2022(row, detector_indices, runlist_config['detectors'], current_period, period_column_index, allowed_periods, separate_22o_test)
-            else: is_good_run, current_period = check_run_quality(row, detector_indices, runlist_config['detectors'], current_period, period_column_index, allowed_periods)
-            default_periods.add(current_period)
+        for row, stripped_row in zip(data_rows, stripped_rows):
+            period_cell, *detector_cells = get_cells(stripped_row)
+            is_good_run, current_period = check_fn(period_cell, detector_cells, quality_flag_sets, current_period, allowed, *extra_args)
+            add_default_period(current_period)
             if is_good_run:
-                if sheet_config.get('sheet_name') == "QC_summary_data_2022":
-                    runlist.append(row[0])
-                else: runlist.append(row[3])
+                runlist.append(row[run_col])
 
         if allowed_periods:
             unique_periods = allowed_periods
@@ -102,9 +222,10 @@ for sheet_config in config['sheets']:
             unique_periods = default_periods
             file_name_suffix = sheet_config['tab_name'].replace('/', '_')
             
-        with open(f'Runlist_{file_name_suffix}_{pass_name}_{runlist_config["name"]}_{current_date}.txt', 'w') as file:
+        with open(f'Runlist_{file_name_suffix}_{pass_name}_{runlist_config["name"]}_{current_date}.txt', 'w', buffering=1 << 20) as file:
             file.write(f'# Creation Date: {current_date}, Pass: {pass_name}, Periods: {", ".join(unique_periods)}\n')
-            file.write(','.join(runlist))
+            # Stream the runs into the buffer instead of first joining them into one large string
+            file.writelines(run if i == 0 else ',' + run for i, run in enumerate(runlist))
 
         print(f'Runlist {runlist_config["name"]} has been generated with {len(runlist)} runs.')
 